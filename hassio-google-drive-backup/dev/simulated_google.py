@@ -1,34 +1,123 @@
-import re
+import functools
+import json
 
 from yarl import URL
 from datetime import timedelta
 from backup.logger import getLogger
 from backup.config import Setting, Config
 from backup.time import Time
-from aiohttp.web import (HTTPBadRequest, HTTPNotFound,
-                         HTTPUnauthorized, Request, Response, delete, get,
-                         json_response, patch, post, put, HTTPSeeOther)
+from aiohttp.web import (HTTPBadRequest, HTTPNotFound, HTTPMethodNotAllowed,
+                         HTTPUnauthorized, Request, Response, get,
+                         post, route, HTTPSeeOther)
 from injector import inject, singleton
-from .base_server import BaseServer, bytesPattern, intPattern
+from .base_server import BaseServer
 from .ports import Ports
 from typing import Any, Dict
-from asyncio import Event
+from asyncio import Event, get_running_loop, shield
+from collections import defaultdict
 from backup.creds import Creds
 
+try:
+    import orjson
+
+    def _dumps(obj) -> bytes:
+        return orjson.dumps(obj)
+except ImportError:
+    def _dumps(obj) -> bytes:
+        return json.dumps(obj).encode()
+
 logger = getLogger(__name__)
 
-mimeTypeQueryPattern = re.compile("^mimeType='.*'$")
-parentsQueryPattern = re.compile("^'.*' in parents$")
-resumeBytesPattern = re.compile("^bytes \\*/\\d+$")
+FORBIDDEN_BODY = b'{"error": {"errors": [{"reason": "forbidden"}]}}'
+QUOTA_EXCEEDED_BODY = b'{"error": {"errors": [{"reason": "storageQuotaExceeded"}]}}'
 
 URL_MATCH_UPLOAD = "^/upload/drive/v3/files/$"
 URL_MATCH_UPLOAD_PROGRESS = "^/upload/drive/v3/files/progress/.*$"
 URL_MATCH_CREATE = "^/upload/drive/v3/files/progress/.*$"
 URL_MATCH_FILE = "^/drive/v3/files/.*$"
 
+# Stands in for the item id segment in drive route paths
+ITEM_ID = object()
+
+
+def _jsonResponse(obj, status: int = 200) -> Response:
+    return Response(body=_dumps(obj), status=status, content_type="application/json")
+
+
+@functools.lru_cache(maxsize=256)
+def _parseFields(source: str) -> tuple:
+    fields = []
+    for field in source.split(","):
+        if field.startswith("files("):
+            fields.append(field[6:])
+        elif field.endswith(")"):
+            fields.append(field[:-1])
+        else:
+            fields.append(field)
+    return tuple(fields)
+
+
+class UploadInfo:
+    __slots__ = ('size', 'mime', 'item', 'id', 'next_start', 'written')
+
+    def __init__(self, size: int = 0, mime: str = "", item: dict = None, id: str = "", next_start: int = 0, written: int = 0):
+        self.size = size
+        self.mime = mime
+        self.item = item
+        self.id = id
+        self.next_start = next_start
+        self.written = written
+
+
+# Drive items stored column-wise, as one dict of id -> value per field
+class ItemStore:
+    def __init__(self):
+        self._ids: Dict[str, None] = {}
+        self._columns: Dict[str, Dict[str, Any]] = defaultdict(dict)
+
+    def __contains__(self, id) -> bool:
+        return id in self._ids
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def ids(self):
+        return self._ids.keys()
+
+    def put(self, id: str, item: Dict[str, Any]):
+        self._ids[id] = None
+        for field, value in item.items():
+            self._columns[field][id] = value
+
+    def remove(self, id: str):
+        del self._ids[id]
+        for column in self._columns.values():
+            column.pop(id, None)
+
+    def field(self, id: str, field: str, default=None) -> Any:
+        return self._columns.get(field, {}).get(id, default)
+
+    def setField(self, id: str, field: str, value: Any):
+        self._columns[field][id] = value
+
+    def project(self, id: str, fields) -> Dict[str, Any]:
+        return {field: self._columns[field][id] for field in fields if id in self._columns.get(field, ())}
+
+    def metadata(self, id: str) -> Dict[str, Any]:
+        # Everything but the file's contents, which aren't metadata
+        return {field: column[id] for field, column in self._columns.items() if field != 'bytes' and id in column}
+
 
 @singleton
 class SimulatedGoogle(BaseServer):
+    _OAUTH_EXPECTED = {
+        'scope': 'https://www.googleapis.com/auth/drive.file',
+        'response_type': 'code',
+        'include_granted_scopes': 'true',
+        'access_type': 'offline',
+        'prompt': 'consent',
+    }
+
     @inject
     def __init__(self, config: Config, time: Time, ports: Ports):
         self._time = time
@@ -39,22 +128,36 @@ class SimulatedGoogle(BaseServer):
         self._custom_drive_client_secret = self.generateId(5)
         self._drive_auth_code = "drive_auth_code"
         self._port = ports.server
+        self._upload_location_prefix = "http://localhost:{}/upload/drive/v3/files/progress/".format(self._port)
         self._auth_token = ""
+        self._expected_auth = "Bearer "
         self._refresh_token = "test_refresh_token"
         self._client_id_hack = None
 
         # Drive item states
-        self.items = {}
-        self.lostPermission = []
+        self.items = ItemStore()
+        self.lostPermission = set()
+        # Ids indexed by mimeType and parent, kept as dicts so queries list items in creation order
+        self._by_mime = defaultdict(dict)
+        self._by_parent = defaultdict(dict)
         self.space_available = 1024 * 1024 * 100  # 100 Mb
+        self._total_stored_bytes = 0
 
         # Upload state information
-        self._upload_info: Dict[str, Any] = {}
+        self._upload_info = UploadInfo()
         self.chunks = []
-        self._upload_chunk_wait = Event()
         self._upload_chunk_trigger = Event()
         self._current_chunk = 1
         self._waitOnChunk = 0
+        self._chunk_fut = None
+
+        # Drive file endpoints, keyed on path segments and then method
+        self._file_routes = {
+            ('upload', 'drive', 'v3', 'files', ''): {'POST': self._upload},
+            ('upload', 'drive', 'v3', 'files', 'progress', ITEM_ID): {'PUT': self._uploadProgress},
+            ('drive', 'v3', 'files', ''): {'POST': self._create, 'GET': self._query, 'HEAD': self._query},
+            ('drive', 'v3', 'files', ITEM_ID, ''): {'DELETE': self._delete, 'PATCH': self._update, 'GET': self._get, 'HEAD': self._get},
+        }
 
     def setDriveSpaceAvailable(self, bytes_available):
         self.space_available = bytes_available
@@ -62,6 +165,7 @@ class SimulatedGoogle(BaseServer):
     def generateNewAccessToken(self):
         new_token = self.generateId(20)
         self._auth_token = new_token
+        self._expected_auth = "Bearer " + new_token
 
     def generateNewRefreshToken(self):
         new_token = self.generateId(20)
@@ -88,48 +192,55 @@ class SimulatedGoogle(BaseServer):
 
     def routes(self):
         return [
-            put('/upload/drive/v3/files/progress/{id}', self._uploadProgress),
-            post('/upload/drive/v3/files/', self._upload),
-            post('/drive/v3/files/', self._create),
-            get('/drive/v3/files/', self._query),
-            delete('/drive/v3/files/{id}/', self._delete),
-            patch('/drive/v3/files/{id}/', self._update),
-            get('/drive/v3/files/{id}/', self._get),
+            route('*', '/upload/drive/v3/files/{tail:.*}', self._dispatchFiles),
+            route('*', '/drive/v3/files/{tail:.*}', self._dispatchFiles),
             post('/oauth2/v4/token', self._oauth2Token),
             get('/o/oauth2/v2/auth', self._oAuth2Authorize),
             get('/drive/customcreds', self._getCustomCred),
             post('/token', self._driveToken),
         ]
 
+    async def _dispatchFiles(self, request: Request):
+        segments = tuple(request.path.split('/')[1:])
+        methods = self._file_routes.get(segments)
+        args = ()
+        if methods is None:
+            # The item id is either the last segment or the one before a trailing slash
+            for index in (-1, -2):
+                template = list(segments)
+                template[index] = ITEM_ID
+                methods = self._file_routes.get(tuple(template))
+                if methods is not None and len(segments[index]) > 0:
+                    args = (segments[index],)
+                    break
+            else:
+                raise HTTPNotFound()
+        handler = methods.get(request.method)
+        if handler is None:
+            raise HTTPMethodNotAllowed(request.method, methods.keys())
+        return await handler(request, *args)
+
     async def _checkDriveHeaders(self, request: Request):
-        if request.headers.get("Authorization", "") != "Bearer " + self._auth_token:
+        if request.headers.get("Authorization", "") != self._expected_auth:
             raise HTTPUnauthorized()
 
     async def _oAuth2Authorize(self, request: Request):
         query = request.query
-        if query.get('client_id') != self.config.get(Setting.DEFAULT_DRIVE_CLIENT_ID) and query.get('client_id') != self._custom_drive_client_id:
-            raise HTTPUnauthorized()
-        if query.get('scope') != 'https://www.googleapis.com/auth/drive.file':
-            raise HTTPUnauthorized()
-        if query.get('response_type') != 'code':
+        if query.get('client_id') not in (self.config.get(Setting.DEFAULT_DRIVE_CLIENT_ID), self._custom_drive_client_id):
             raise HTTPUnauthorized()
-        if query.get('include_granted_scopes') != 'true':
-            raise HTTPUnauthorized()
-        if query.get('access_type') != 'offline':
+        if any(query.get(key) != value for key, value in self._OAUTH_EXPECTED.items()):
             raise HTTPUnauthorized()
         if 'state' not in query:
             raise HTTPUnauthorized()
         if 'redirect_uri' not in query:
             raise HTTPUnauthorized()
-        if query.get('prompt') != 'consent':
-            raise HTTPUnauthorized()
         if query.get('redirect_uri') == 'urn:ietf:wg:oauth:2.0:oob':
-            return json_response({"code": self._drive_auth_code})
+            return _jsonResponse({"code": self._drive_auth_code})
         url = URL(query.get('redirect_uri')).with_query({'code': self._drive_auth_code, 'state': query.get('state')})
         raise HTTPSeeOther(str(url))
 
     async def _getCustomCred(self, request: Request):
-        return json_response({
+        return _jsonResponse({
             "client_id": self._custom_drive_client_id,
             "client_secret": self._custom_drive_client_secret
         })
@@ -145,7 +256,7 @@ class SimulatedGoogle(BaseServer):
         if data.get('code') != self._drive_auth_code:
             raise HTTPUnauthorized()
         self.generateNewRefreshToken()
-        return json_response({
+        return _jsonResponse({
             'access_token': self._auth_token,
             'refresh_token': self._refresh_token,
             'client_id': data.get('client_id'),
@@ -175,29 +286,21 @@ class SimulatedGoogle(BaseServer):
 
         self.generateNewAccessToken()
 
-        return json_response({
+        return _jsonResponse({
             'access_token': self._auth_token,
             'expires_in': 3600,
             'token_type': 'doesn\'t matter'
         })
 
-    def filter_fields(self, item: Dict[str, Any], fields) -> Dict[str, Any]:
-        ret = {}
-        for field in fields:
-            if field in item:
-                ret[field] = item[field]
-        return ret
-
-    def parseFields(self, source: str):
-        fields = []
-        for field in source.split(","):
-            if field.startswith("files("):
-                fields.append(field[6:])
-            elif field.endswith(")"):
-                fields.append(field[:-1])
-            else:
-                fields.append(field)
-        return fields
+    def filter_fields(self, id: str, fields) -> Dict[str, Any]:
+        if len(fields) == 1 and fields[0] == 'id':
+            return {'id': id}
+        if '*' in fields:
+            return self.items.metadata(id)
+        return self.items.project(id, fields)
+
+    def _listItems(self, ids, fields):
+        return [self.filter_fields(id, fields) for id in ids]
 
     def formatItem(self, base, id):
         base['capabilities'] = {'canAddChildren': True,
@@ -207,78 +310,97 @@ class SimulatedGoogle(BaseServer):
         base['modifiedTime'] = self.timeToRfc3339String(self._time.now())
         return base
 
-    async def _get(self, request: Request):
-        id = request.match_info.get('id')
+    def _indexItem(self, id):
+        self._by_mime[self.items.field(id, 'mimeType', '')][id] = None
+        for parent in self.items.field(id, 'parents', []):
+            self._by_parent[parent][id] = None
+
+    def _unindexItem(self, id):
+        self._dropIndexEntry(self._by_mime, self.items.field(id, 'mimeType', ''), id)
+        for parent in self.items.field(id, 'parents', []):
+            self._dropIndexEntry(self._by_parent, parent, id)
+
+    def _dropIndexEntry(self, index, key, id):
+        bucket = index.get(key)
+        if bucket is not None:
+            bucket.pop(id, None)
+            if not bucket:
+                del index[key]
+
+    async def _get(self, request: Request, id: str):
         await self._checkDriveHeaders(request)
         if id not in self.items:
             raise HTTPNotFound()
         if id in self.lostPermission:
-            return Response(
-                status=403,
-                content_type="application/json",
-                text='{"error": {"errors": [{"reason": "forbidden"}]}}')
+            return Response(status=403, content_type="application/json", body=FORBIDDEN_BODY)
         request_type = request.query.get("alt", "metadata")
         if request_type == "media":
             # return bytes
-            item = self.items[id]
-            if 'bytes' not in item:
+            data = self.items.field(id, 'bytes')
+            if data is None:
                 raise HTTPBadRequest()
-            return self.serve_bytes(request, item['bytes'], include_length=False)
+            return self.serve_bytes(request, data, include_length=False)
         else:
             fields = request.query.get("fields", "id").split(",")
-            return json_response(self.filter_fields(self.items[id], fields))
+            return _jsonResponse(self.filter_fields(id, fields))
 
-    async def _update(self, request: Request):
-        id = request.match_info.get('id')
+    async def _update(self, request: Request, id: str):
         await self._checkDriveHeaders(request)
         if id not in self.items:
             return HTTPNotFound
         update = await request.json()
+        old_mime = self.items.field(id, 'mimeType', '')
+        old_parents = self.items.field(id, 'parents', [])
+        self._total_stored_bytes -= self.items.field(id, 'size', 0)
         for key in update:
-            if key in self.items[id] and isinstance(self.items[id][key], dict):
-                self.items[id][key].update(update[key])
+            current = self.items.field(id, key)
+            if isinstance(current, dict):
+                current.update(update[key])
             else:
-                self.items[id][key] = update[key]
+                self.items.setField(id, key, update[key])
+        self._total_stored_bytes += self.items.field(id, 'size', 0)
+
+        # Only re-index values that changed, so the item keeps its place in query results
+        if 'mimeType' in update:
+            new_mime = self.items.field(id, 'mimeType', '')
+            if new_mime != old_mime:
+                self._dropIndexEntry(self._by_mime, old_mime, id)
+                self._by_mime[new_mime][id] = None
+        if 'parents' in update:
+            new_parents = self.items.field(id, 'parents', [])
+            for parent in old_parents:
+                if parent not in new_parents:
+                    self._dropIndexEntry(self._by_parent, parent, id)
+            for parent in new_parents:
+                if parent not in old_parents:
+                    self._by_parent[parent][id] = None
         return Response()
 
-    async def _delete(self, request: Request):
-        id = request.match_info.get('id')
+    async def _delete(self, request: Request, id: str):
         await self._checkDriveHeaders(request)
         if id not in self.items:
             raise HTTPNotFound()
-        del self.items[id]
+        self._unindexItem(id)
+        self._total_stored_bytes -= self.items.field(id, 'size', 0)
+        self.items.remove(id)
         return Response()
 
     async def _query(self, request: Request):
         await self._checkDriveHeaders(request)
         query: str = request.query.get("q", "")
-        fields = self.parseFields(request.query.get('fields', 'id'))
-        if mimeTypeQueryPattern.match(query):
-            ret = []
+        fields = _parseFields(request.query.get('fields', 'id'))
+        if len(query) >= len("mimeType=''") and query.startswith("mimeType='") and query.endswith("'"):
             mimeType = query[len("mimeType='"):-1]
-            for item in self.items.values():
-                if item.get('mimeType', '') == mimeType:
-                    ret.append(self.filter_fields(item, fields))
-            return json_response({'files': ret})
-        elif parentsQueryPattern.match(query):
-            ret = []
+            return _jsonResponse({'files': self._listItems(self._by_mime.get(mimeType, ()), fields)})
+        elif len(query) >= len("'' in parents") and query.startswith("'") and query.endswith("' in parents"):
             parent = query[1:-len("' in parents")]
             if parent not in self.items:
                 raise HTTPNotFound()
             if parent in self.lostPermission:
-                return Response(
-                    status=403,
-                    content_type="application/json",
-                    text='{"error": {"errors": [{"reason": "forbidden"}]}}')
-            for item in self.items.values():
-                if parent in item.get('parents', []):
-                    ret.append(self.filter_fields(item, fields))
-            return json_response({'files': ret})
+                return Response(status=403, content_type="application/json", body=FORBIDDEN_BODY)
+            return _jsonResponse({'files': self._listItems(self._by_parent.get(parent, ()), fields)})
         elif len(query) == 0:
-            ret = []
-            for item in self.items.values():
-                ret.append(self.filter_fields(item, fields))
-            return json_response({'files': ret})
+            return _jsonResponse({'files': self._listItems(self.items.ids(), fields)})
         else:
             raise HTTPBadRequest
 
@@ -286,8 +408,10 @@ class SimulatedGoogle(BaseServer):
         await self._checkDriveHeaders(request)
         id = self.generateId(30)
         item = self.formatItem(await request.json(), id)
-        self.items[id] = item
-        return json_response({'id': item['id']})
+        self.items.put(id, item)
+        self._indexItem(id)
+        self._total_stored_bytes += item.get('size', 0)
+        return _jsonResponse({'id': item['id']})
 
     async def _upload(self, request: Request):
         logger.info("Drive start upload request")
@@ -300,97 +424,101 @@ class SimulatedGoogle(BaseServer):
         size = int(request.headers.get('X-Upload-Content-Length', -1))
         if size < 0:
             raise HTTPBadRequest()
-        total_size = 0
-        for item in self.items.values():
-            total_size += item.get('size', 0)
-        total_size += size
-        if total_size > self.space_available:
-            return json_response({
-                "error": {
-                    "errors": [
-                        {"reason": "storageQuotaExceeded"}
-                    ]
-                }
-            }, status=400)
+        if self._total_stored_bytes + size > self.space_available:
+            return Response(status=400, content_type="application/json", body=QUOTA_EXCEEDED_BODY)
         metadata = await request.json()
         id = self.generateId()
 
         # Validate parents
-        if 'parents' in metadata:
-            for parent in metadata['parents']:
-                if parent not in self.items:
-                    raise HTTPNotFound()
-                if parent in self.lostPermission:
-                    return Response(status=403, content_type="application/json", text='{"error": {"errors": [{"reason": "forbidden"}]}}')
-        self._upload_info['size'] = size
-        self._upload_info['mime'] = mimeType
-        self._upload_info['item'] = self.formatItem(metadata, id)
-        self._upload_info['id'] = id
-        self._upload_info['next_start'] = 0
-        metadata['bytes'] = bytearray()
+        parents = metadata.get('parents', ())
+        if any(parent not in self.items for parent in parents):
+            raise HTTPNotFound()
+        if self.lostPermission.intersection(parents):
+            return Response(status=403, content_type="application/json", body=FORBIDDEN_BODY)
+        self._upload_info = UploadInfo(size=size, mime=mimeType, item=self.formatItem(metadata, id), id=id)
+        metadata['bytes'] = bytearray(size)
         metadata['size'] = size
         resp = Response()
-        resp.headers['Location'] = "http://localhost:" + \
-            str(self._port) + "/upload/drive/v3/files/progress/" + id
+        resp.headers['Location'] = self._upload_location_prefix + id
         return resp
 
-    async def _uploadProgress(self, request: Request):
-        if self._waitOnChunk > 0:
-            if self._current_chunk == self._waitOnChunk:
-                self._upload_chunk_trigger.set()
-                await self._upload_chunk_wait.wait()
-            else:
-                self._current_chunk += 1
-        id = request.match_info.get('id')
+    async def _holdChunk(self):
+        if self._current_chunk != self._waitOnChunk:
+            self._current_chunk += 1
+            return
+        if self._chunk_fut is None or self._chunk_fut.done():
+            self._chunk_fut = get_running_loop().create_future()
+        self._upload_chunk_trigger.set()
+        # Shielded so a cancelled request doesn't cancel the future other requests wait on
+        await shield(self._chunk_fut)
+
+    def releaseChunk(self):
+        self._waitOnChunk = 0
+        if self._chunk_fut is not None and not self._chunk_fut.done():
+            self._chunk_fut.set_result(None)
+
+    async def _uploadProgress(self, request: Request, id: str):
+        if self._waitOnChunk:
+            await self._holdChunk()
         await self._checkDriveHeaders(request)
-        if self._upload_info.get('id', "") != id:
+        upload = self._upload_info
+        if upload.id != id:
             raise HTTPBadRequest()
         chunk_size = int(request.headers['Content-Length'])
         info = request.headers['Content-Range']
-        if resumeBytesPattern.match(info):
+        if info.startswith("bytes */") and info[8:].isdecimal():
             resp = Response(status=308)
-            if self._upload_info['next_start'] != 0:
-                resp.headers['Range'] = "bytes=0-{0}".format(self._upload_info['next_start'] - 1)
+            if upload.next_start != 0:
+                resp.headers['Range'] = "bytes=0-{0}".format(upload.next_start - 1)
             return resp
-        if not bytesPattern.match(info):
+        if not info.startswith("bytes "):
             raise HTTPBadRequest()
-        numbers = intPattern.findall(info)
-        start = int(numbers[0])
-        end = int(numbers[1])
-        total = int(numbers[2])
-        if total != self._upload_info['size']:
+        span, _, total = info[6:].partition("/")
+        start, _, end = span.partition("-")
+        if not (start.isdecimal() and end.isdecimal() and total.isdecimal()):
             raise HTTPBadRequest()
-        if start != self._upload_info['next_start']:
+        start, end, total = int(start), int(end), int(total)
+        if total != upload.size:
+            raise HTTPBadRequest()
+        if start != upload.next_start:
             raise HTTPBadRequest()
         if not (end == total - 1 or chunk_size % (256 * 1024) == 0):
             raise HTTPBadRequest()
         if end > total - 1:
             raise HTTPBadRequest()
+        if chunk_size != end - start + 1:
+            raise HTTPBadRequest()
 
-        # get the chunk
-        received_bytes = await self.readAll(request)
+        # stream the chunk directly into the upload's buffer
+        buffer = upload.item['bytes']
+        offset = start
+        async for data in request.content.iter_chunked(65536):
+            if offset + len(data) > end + 1:
+                raise HTTPBadRequest()
+            buffer[offset:offset + len(data)] = data
+            offset += len(data)
+        received = offset - start
 
         # validate the chunk
-        if len(received_bytes) != chunk_size:
-            raise HTTPBadRequest()
-
-        if len(received_bytes) != end - start + 1:
+        if received != chunk_size:
             raise HTTPBadRequest()
 
-        self._upload_info['item']['bytes'].extend(received_bytes)
+        upload.written += received
 
-        if len(self._upload_info['item']['bytes']) != end + 1:
+        if upload.written != end + 1:
             raise HTTPBadRequest()
 
-        self.chunks.append(len(received_bytes))
+        self.chunks.append(received)
         if end == total - 1:
             # upload is complete, so create the item
-            self.items[self._upload_info['id']] = self._upload_info['item']
-            return json_response({"id": self._upload_info['id']})
+            self.items.put(upload.id, upload.item)
+            self._indexItem(upload.id)
+            self._total_stored_bytes += upload.size
+            return _jsonResponse({"id": upload.id})
         else:
             # Return an incomplete response
             # For some reason, the tests like to stop right here
             resp = Response(status=308)
-            self._upload_info['next_start'] = end + 1
+            upload.next_start = end + 1
             resp.headers['Range'] = "bytes=0-{0}".format(end)
             return resp
@@ -1,15 +1,16 @@
 import os
 import json
 from time import sleep
+from urllib.parse import urlencode
 
 import pytest
 import asyncio
 from aiohttp.client_exceptions import ClientResponseError
 from backup.config import Config, Setting
 from dev.simulationserver import SimulationServer
-from dev.simulated_google import SimulatedGoogle, URL_MATCH_UPLOAD_PROGRESS, URL_MATCH_FILE
+from dev.simulated_google import SimulatedGoogle, ItemStore, URL_MATCH_UPLOAD_PROGRESS, URL_MATCH_FILE
 from dev.request_interceptor import RequestInterceptor
-from backup.drive import DriveSource, FolderFinder
+from backup.drive import DriveSource, FolderFinder, DriveRequests
 from backup.drive.driverequests import (BASE_CHUNK_SIZE,
                                         CHUNK_UPLOAD_TARGET_SECONDS, MAX_CHUNK_SIZE,
                                         RETRY_SESSION_ATTEMPTS)
@@ -481,7 +482,7 @@ async def test_recreate_folder_when_deleted(time, drive: DriveSource, config: Co
 async def test_recreate_folder_when_losing_permissions(time, drive: DriveSource, config: Config, snapshot_helper, google: SimulatedGoogle):
     await drive.get()
     id = await drive.getFolderId()
-    google.lostPermission.append(id)
+    google.lostPermission.add(id)
     assert len(await drive.get()) == 0
     assert id != await drive.getFolderId()
 
@@ -514,7 +515,7 @@ async def test_folder_error_on_upload_lost_permission(time, drive: DriveSource,
     config.override(Setting.SPECIFY_SNAPSHOT_FOLDER, True)
 
     # Make the folder inaccessible
-    google.lostPermission.append(await drive.getFolderId())
+    google.lostPermission.add(await drive.getFolderId())
     time.advanceDay()
 
     # Fail to upload
@@ -534,7 +535,7 @@ async def test_folder_error_on_upload_lost_permission_custom_client(time, drive:
     config.override(Setting.DEFAULT_DRIVE_CLIENT_ID, "something-else")
 
     # Make the folder inaccessible
-    google.lostPermission.append(await drive.getFolderId())
+    google.lostPermission.add(await drive.getFolderId())
     time.advanceDay()
 
     # Fail to upload
@@ -552,7 +553,7 @@ async def test_folder_error_on_query_lost_permission(time, drive: DriveSource, c
     config.override(Setting.DEFAULT_DRIVE_CLIENT_ID, "something")
 
     # Make the folder inaccessible
-    google.lostPermission.append(await drive.getFolderId())
+    google.lostPermission.add(await drive.getFolderId())
 
     # It shoudl fail!
     with pytest.raises(BackupFolderInaccessible):
@@ -798,3 +799,142 @@ async def test_resume_session_reused_on_http410(time, drive: DriveSource, config
 
     interceptor.setError(drive.drivebackend.last_attempt_location, 0, 410)
     await drive.save(from_snapshot, data)
+
+
+@pytest.mark.asyncio
+async def test_query_order_kept_after_update(drive_requests: DriveRequests):
+    parent = (await drive_requests.createFolder({'name': "parent", 'mimeType': FOLDER_MIME_TYPE}))['id']
+    ids = []
+    for name in ["a", "b", "c"]:
+        ids.append((await drive_requests.createFolder({'name': name, 'mimeType': "test/type", 'parents': [parent]}))['id'])
+
+    await drive_requests.update(ids[0], {'appProperties': {'retained': "true"}})
+    assert [item['id'] async for item in drive_requests.query("'{}' in parents".format(parent))] == ids
+    assert [item['id'] async for item in drive_requests.query("mimeType='test/type'")] == ids
+
+    await drive_requests.update(ids[0], {'parents': []})
+    assert [item['id'] async for item in drive_requests.query("'{}' in parents".format(parent))] == ids[1:]
+
+
+@pytest.mark.asyncio
+async def test_drive_file_routes_match_exactly(drive_requests: DriveRequests, session, server_url):
+    id = (await drive_requests.createFolder({'name': "folder", 'mimeType': FOLDER_MIME_TYPE}))['id']
+    headers = await drive_requests._getHeaders()
+    base = server_url + "/drive/v3/files/"
+
+    async with session.get(base + id + "/", headers=headers) as resp:
+        assert resp.status == 200
+    async with session.head(base + id + "/", headers=headers) as resp:
+        assert resp.status == 200
+    async with session.head(base, headers=headers) as resp:
+        assert resp.status == 200
+    async with session.get(base + id, headers=headers) as resp:
+        assert resp.status == 404
+    async with session.get(base + id + "/extra/", headers=headers) as resp:
+        assert resp.status == 404
+    async with session.put(base + id + "/", headers=headers) as resp:
+        assert resp.status == 405
+    async with session.delete(base, headers=headers) as resp:
+        assert resp.status == 405
+    async with session.put(server_url + "/upload/drive/v3/files/progress/", headers=headers) as resp:
+        assert resp.status == 404
+
+
+@pytest.mark.asyncio
+async def test_wildcard_fields_exclude_bytes(drive: DriveSource, drive_requests: DriveRequests, snapshot_helper):
+    from_snapshot, data = await snapshot_helper.createFile()
+    snapshot: DriveSnapshot = await drive.save(from_snapshot, data)
+
+    item = await drive_requests.retryRequest("GET", "/drive/v3/files/" + snapshot.id() + "/?fields=*", is_json=True)
+    assert item['id'] == snapshot.id()
+    assert item['size'] == data.size()
+    assert 'bytes' not in item
+
+    query = urlencode({'q': "'{}' in parents".format(await drive.getFolderId()), 'fields': "*"})
+    listed = await drive_requests.retryRequest("GET", "/drive/v3/files/?" + query, is_json=True)
+    assert [file['id'] for file in listed['files']] == [snapshot.id()]
+    assert 'bytes' not in listed['files'][0]
+    assert listed['files'][0]['size'] == data.size()
+
+
+def test_item_store_remove_clears_columns():
+    store = ItemStore()
+    store.put("a", {'id': "a", 'name': "first", 'bytes': bytearray(2)})
+    store.put("b", {'id': "b", 'name': "second", 'size': 10})
+    store.remove("a")
+
+    assert "a" not in store
+    assert list(store.ids()) == ["b"]
+    assert store.field("a", 'name') is None
+    assert store.field("a", 'bytes') is None
+    assert store.metadata("a") == {}
+    assert store.metadata("b") == {'id': "b", 'name': "second", 'size': 10}
+
+
+@pytest.mark.asyncio
+async def test_update_merges_nested_fields(drive_requests: DriveRequests, google: SimulatedGoogle):
+    id = (await drive_requests.createFolder({'name': "folder", 'mimeType': FOLDER_MIME_TYPE, 'appProperties': {'first': "1"}}))['id']
+    properties = google.items.field(id, 'appProperties')
+
+    await drive_requests.update(id, {'appProperties': {'second': "2"}, 'name': "renamed"})
+
+    assert google.items.field(id, 'appProperties') is properties
+    assert properties == {'first': "1", 'second': "2"}
+    item = await drive_requests.get(id)
+    assert item['appProperties'] == {'first': "1", 'second': "2"}
+    assert item['name'] == "renamed"
+
+
+@pytest.mark.asyncio
+async def test_hold_and_release_chunk(drive: DriveSource, google: SimulatedGoogle, snapshot_helper: SnapshotHelper):
+    google._waitOnChunk = 2
+    from_snapshot, data = await snapshot_helper.createFile()
+    save_task = asyncio.create_task(drive.save(from_snapshot, data))
+
+    # The first chunk goes through, the second is held
+    await asyncio.wait_for(google._upload_chunk_trigger.wait(), timeout=5)
+    assert google.chunks == [BASE_CHUNK_SIZE]
+    assert not save_task.done()
+
+    google.releaseChunk()
+    drive_snapshot = await asyncio.wait_for(save_task, timeout=5)
+    assert drive_snapshot.size() == data.size()
+    assert sum(google.chunks) == data.size()
+
+
+@pytest.mark.asyncio
+async def test_release_chunk_frees_retried_requests(drive_requests: DriveRequests, google: SimulatedGoogle, session, server_url):
+    headers = await drive_requests._getHeaders()
+    start_headers = dict(headers)
+    start_headers['X-Upload-Content-Type'] = "application/tar"
+    start_headers['X-Upload-Content-Length'] = "10"
+    async with session.post(server_url + "/upload/drive/v3/files/?uploadType=resumable", headers=start_headers, json={'name': "test"}) as resp:
+        assert resp.status == 200
+        location = resp.headers['Location']
+
+    google._waitOnChunk = 1
+    chunk_headers = dict(headers)
+    chunk_headers['Content-Range'] = "bytes 0-9/10"
+
+    async def putChunk():
+        async with session.put(location, headers=chunk_headers, data=bytes(10)) as resp:
+            return resp.status
+
+    # Two requests for the held chunk, as when a client times out and retries it
+    first = asyncio.create_task(putChunk())
+    await asyncio.wait_for(google._upload_chunk_trigger.wait(), timeout=5)
+    second = asyncio.create_task(putChunk())
+    await asyncio.sleep(0.1)
+    assert not first.done()
+    assert not second.done()
+
+    google.releaseChunk()
+    assert sorted(await asyncio.wait_for(asyncio.gather(first, second), timeout=5)) == [200, 400]
+
+
+@pytest.mark.asyncio
+async def test_truncated_queries_rejected(drive_requests: DriveRequests, session, server_url):
+    headers = await drive_requests._getHeaders()
+    for query in ["mimeType='", "' in parents"]:
+        async with session.get(server_url + "/drive/v3/files/?" + urlencode({'q': query}), headers=headers) as resp:
+            assert resp.status == 400